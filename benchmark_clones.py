@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark full, partial and shallow clones of a fork against a local file://
+remote
+
+Builds a synthetic upstream repository, clones it each way and reports the
+size of the packs received, the disk used by the clone and the time taken.
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from subprocess import *
+
+from rebase_forks import ForkRebase, RepoFork, run_git, disk_usage
+
+class Benchmark(object):
+    """
+    Compares the ways of cloning a fork
+    """
+
+    def __init__(self):
+        """
+        Run the benchmark
+        """
+        self.args = None
+        self.parse_args()
+
+        self.workdir = tempfile.mkdtemp(prefix='polycephaly-benchmark.')
+        self.upstream = '%s/upstream.git' % self.workdir
+
+        try:
+            self.create_upstream()
+            self.run()
+        finally:
+            shutil.rmtree(self.workdir)
+
+    def parse_args(self):
+        """
+        Get the arguments from the command line
+        """
+        parser = argparse.ArgumentParser()
+
+        parser.add_argument(
+            '--commits',
+            type=int,
+            default=200,
+            help='Number of commits in the upstream repository.'
+        )
+
+        parser.add_argument(
+            '--files',
+            type=int,
+            default=5,
+            help='Number of files changed by each commit.'
+        )
+
+        parser.add_argument(
+            '--size',
+            type=int,
+            default=20000,
+            help='Size in bytes of each changed file.'
+        )
+
+        parser.add_argument(
+            '--depth',
+            type=int,
+            default=1,
+            help='Depth of the shallow clones.'
+        )
+
+        parser.add_argument(
+            '--filter',
+            default='blob:none',
+            help='Filter for the partial clones.'
+        )
+
+        self.args = parser.parse_args()
+
+    def create_upstream(self):
+        """
+        Create a bare upstream repository with random file contents, so that
+        the blobs do not compress away
+        """
+        run_git(['init', '--bare', self.upstream], self.workdir)
+
+        # Let the clones ask for filtered packs and missing objects
+        for key in ['uploadpack.allowFilter', 'uploadpack.allowAnySHA1InWant']:
+            run_git(['config', key, 'true'], self.upstream)
+
+        fast_import = Popen(
+            ['git', 'fast-import', '--quiet'],
+            cwd=self.upstream,
+            stdin=PIPE
+        )
+
+        for commit in range(1, self.args.commits + 1):
+            message = b'Commit %d\n' % commit
+            fast_import.stdin.write(
+                b'commit refs/heads/master\n'\
+                b'mark :%d\n'\
+                b'committer Benchmark <benchmark@example.com> %d +0000\n'\
+                b'data %d\n%s'\
+                % (commit, commit, len(message), message)
+            )
+            if commit > 1:
+                fast_import.stdin.write(b'from :%d\n' % (commit - 1))
+
+            for number in range(self.args.files):
+                contents = os.urandom(self.args.size)
+                fast_import.stdin.write(
+                    b'M 100644 inline file%d\ndata %d\n%s\n'\
+                    % ((commit + number) % (self.args.files * 4),
+                       len(contents), contents)
+                )
+
+        fast_import.stdin.close()
+        if fast_import.wait() != 0:
+            raise ForkRebase('Failed to create the upstream repository')
+
+    def measure(self, name, setup):
+        """
+        Time the setup of a clone and print the pack and disk sizes
+        """
+        started = time.time()
+        fork = setup('%s/%s' % (self.workdir, name))
+        elapsed = time.time() - started
+
+        packdir = '%s/.git/objects/pack' % fork.dirname
+        packs = sum(
+            os.path.getsize('%s/%s' % (packdir, filename))
+            for filename in os.listdir(packdir)
+            if filename.endswith('.pack')
+        )
+
+        print(
+            '%-20s %10.1f %10.1f %10.2f'\
+            % (name, packs / 2**20, disk_usage(fork.dirname) / 2**20, elapsed)
+        )
+
+    def run(self):
+        """
+        Clone the upstream in each way
+        """
+        url = 'file://%s' % self.upstream
+        depth = self.args.depth
+        clone_filter = self.args.filter
+
+        def clone(clone_filter=None, depth=None):
+            """
+            Returns a function that makes a clone at the given path
+            """
+            return lambda path: RepoFork.clone(
+                os.path.dirname(path),
+                os.path.basename(path),
+                url,
+                clone_filter,
+                depth
+            )
+
+        def convert(path):
+            """
+            Make a full clone at the given path and convert it
+            """
+            fork = clone()(path)
+            fork.convert(clone_filter, depth)
+            return fork
+
+        print(
+            '%-20s %10s %10s %10s'\
+            % ('Clone', 'Pack MiB', 'Disk MiB', 'Seconds')
+        )
+        self.measure('full', clone())
+        self.measure('partial', clone(clone_filter))
+        self.measure('shallow', clone(depth=depth))
+        self.measure('partial+shallow', clone(clone_filter, depth))
+        self.measure('converted', convert)
+
+if __name__ == '__main__':
+
+    Benchmark()
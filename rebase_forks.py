@@ -9,15 +9,232 @@ from tkinter import *
 from tkinter import ttk
 import re
 import os
+import sys
+import time
+import shutil
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+from bisect import bisect, bisect_left
 from subprocess import *
 import argparse
 import configparser
 
+# Number of lines of git output kept for error messages
+OUTPUT_LINES = 20
+
+# Longest line of git output that is kept, in bytes
+MAX_LINE_LENGTH = 4096
+
+# States a fork can be in during a rebase, and their colour in the repo table
+FORK_STATES = ('pending', 'running', 'ok', 'skipped', 'failed')
+STATE_COLOURS = {
+    'pending': 'black',
+    'running': 'blue',
+    'ok': 'green',
+    'skipped': 'grey',
+    'failed': 'red',
+}
+
+# Number of lines inserted into the repo table at a time
+ROW_BATCH = 200
+
+# Commits fetched the first time a shallow fork is deepened, doubling for
+# each attempt before the full history is fetched
+DEEPEN_DEPTH = 50
+DEEPEN_ATTEMPTS = 5
+
 class ForkRebase(Exception):
     """
     Raised for errors in this script
     """
 
+class GitProgress(object):
+    """
+    Progress of a git command, parsed from its --progress output
+    """
+
+    # Matches progress lines such as:
+    #   remote: Counting objects: 100% (10/10), done.
+    #   Receiving objects:  45% (450/1000), 1.20 MiB | 2.40 MiB/s
+    progress_re = re.compile(
+        r'^(?:remote:\s*)?(?P<phase>[A-Za-z][A-Za-z ]*?):\s+'\
+        r'(?P<percent>\d+)%\s+'\
+        r'\((?P<done>\d+)/(?P<total>\d+)\)'\
+        r'(?:,\s+(?P<transferred>[\d.]+\s+(?:bytes?|[KMGT]iB))'\
+        r'(?:\s+\|\s+(?P<rate>[\d.]+\s+(?:bytes?|[KMGT]iB)/s))?)?'
+    )
+
+    def __init__(self, command, output_lines=OUTPUT_LINES):
+        """
+        Initialize the progress of a command
+
+        command is the command line as a string
+        output_lines is the number of lines of output to keep, or None to
+        keep all of it
+        """
+        self.command = command
+        self.output = deque(maxlen=output_lines)
+        self.phase = None
+        self.percent = None
+        self.done = None
+        self.total = None
+        self.transferred = None
+        self.rate = None
+        self.started = time.time()
+        self.finished = None
+
+    def parse(self, line):
+        """
+        Update the progress from a line of git output
+
+        Returns True if the line was a progress line
+        """
+        matches = self.progress_re.search(line)
+        if not matches:
+            return False
+
+        # Transfer figures only belong to the phase that reported them
+        if matches.group('phase') != self.phase:
+            self.transferred = None
+            self.rate = None
+
+        self.phase = matches.group('phase')
+        self.percent = int(matches.group('percent'))
+        self.done = int(matches.group('done'))
+        self.total = int(matches.group('total'))
+        if matches.group('transferred'):
+            self.transferred = matches.group('transferred')
+        if matches.group('rate'):
+            self.rate = matches.group('rate')
+        return True
+
+    def finish(self):
+        """
+        Record that the command has finished
+        """
+        self.finished = time.time()
+
+    def elapsed(self):
+        """
+        Seconds the command has been running for
+        """
+        return (self.finished or time.time()) - self.started
+
+    def __str__(self):
+        """
+        Returns string representation of a GitProgress
+        """
+        if not self.phase:
+            return ''
+
+        representation = '%s %d%% (%d/%d)'\
+            % (self.phase, self.percent, self.done, self.total)
+
+        if self.transferred:
+            representation += ', %s' % self.transferred
+        if self.rate:
+            representation += ' | %s' % self.rate
+
+        return representation
+
+def split_output(partial, chunk):
+    """
+    Split git output into lines as it is read
+
+    partial is the incomplete line left over from the previous chunk. Returns
+    the complete, non-blank lines as strings and the new incomplete line.
+    Lines are capped at MAX_LINE_LENGTH bytes, keeping the end of the line.
+    """
+    # git redraws progress lines with a carriage return
+    lines = re.split(rb'[\r\n]', partial + chunk)
+    partial = lines.pop()[-MAX_LINE_LENGTH:]
+
+    return (
+        [
+            line[-MAX_LINE_LENGTH:].decode('utf-8', 'replace').strip()
+            for line in lines if line.strip()
+        ],
+        partial
+    )
+
+def run_git(arguments, cwd, progress=None, output_lines=OUTPUT_LINES,
+            stdout_only=False):
+    """
+    Run a git command in the given directory
+
+    Output is read as git prints it rather than buffered until the command
+    exits. If progress is given it is called with a GitProgress whenever git
+    reports progress. Only the last output_lines lines of other output are
+    kept, in the output of the returned GitProgress and for the error
+    message.
+
+    Progress and warnings are written to stderr, which is read along with
+    stdout unless stdout_only is set. Plumbing commands whose output is
+    parsed should set it, so that warnings cannot be mistaken for output.
+    Their stderr goes to a temporary file, used only for the error message.
+    """
+    status = GitProgress(' '.join(['git'] + arguments), output_lines)
+    errors = tempfile.TemporaryFile() if stdout_only else None
+
+    try:
+        git_command = Popen(
+            ['git'] + arguments,
+            cwd=cwd,
+            stdout=PIPE,
+            stderr=errors or STDOUT
+        )
+    except OSError as error:
+        raise ForkRebase(
+            'Could not run \'%s\'.\n%s' % (status.command, error)
+        )
+
+    partial = b''
+    while True:
+        chunk = git_command.stdout.read1(MAX_LINE_LENGTH)
+        if not chunk:
+            break
+
+        (lines, partial) = split_output(partial, chunk)
+        for line in lines:
+            if status.parse(line):
+                if progress:
+                    progress(status)
+            else:
+                status.output.append(line)
+
+    status.output.extend(split_output(partial, b'\n')[0])
+
+    git_command.stdout.close()
+    git_command.wait()
+    status.finish()
+
+    message = status.output
+    if errors:
+        # Only the end of stderr is needed for the error message
+        errors.seek(max(0, errors.seek(0, 2) - MAX_LINE_LENGTH))
+        message = split_output(errors.read(), b'\n')[0][-OUTPUT_LINES:]
+        errors.close()
+
+    if git_command.returncode != 0:
+        raise ForkRebase(
+            'Failed to run \'%s\'.\n%s'\
+            % (status.command, '\n'.join(message))
+        )
+
+    return status
+
+def disk_usage(path):
+    """
+    Returns the number of bytes used by the files under a path
+    """
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            total += os.lstat(os.path.join(dirpath, filename)).st_size
+    return total
+
 class RepoFork(object):
     """
     Represents a repository fork
@@ -35,9 +252,6 @@ class RepoFork(object):
         self.basedir = basedir
         self.dirname = "%s/%s" % (self.basedir, dirname)
 
-        # cd into our fork directory
-        os.chdir(self.dirname)
-
         # Get the remotes for the current
         self.remotes = None
         self.get_remotes()
@@ -46,6 +260,9 @@ class RepoFork(object):
         self.current_branch = None
         self.get_current_branch()
 
+        # Progress of the last run of each git command, used for timings
+        self.timings = {}
+
     def get_remotes(self):
         """
         Work out the remote repositories for this fork
@@ -65,6 +282,7 @@ class RepoFork(object):
                 # Run the git remote command
                 remote_command = Popen(
                     ['git', 'remote', '-v'],
+                    cwd=self.dirname,
                     stdout=PIPE,
                     stderr=PIPE
                 )
@@ -102,6 +320,7 @@ class RepoFork(object):
                 # Run the git branch command
                 branch_command = Popen(
                     ['git', 'branch'],
+                    cwd=self.dirname,
                     stdout=PIPE,
                     stderr=PIPE
                 )
@@ -123,128 +342,425 @@ class RepoFork(object):
 
         return self.current_branch
 
-    def create_remote(self, name, repopath):
+    def run_git(self, arguments, progress=None, output_lines=OUTPUT_LINES,
+                stdout_only=False):
         """
-        Defines a remote repository
+        Run a git command in the fork directory, keeping its progress in the
+        timings
         """
-        os.chdir(self.dirname)
-        try:
-            # Run the git remote command
-            remote_command = Popen(
-                ['git', 'remote', 'add', name, repopath],
-                stdout=PIPE,
-                stderr=PIPE
-            )
-            (stdout, stderr) = remote_command.communicate()[:2]
+        status = run_git(
+            arguments,
+            self.dirname,
+            progress,
+            output_lines,
+            stdout_only
+        )
+        self.timings[status.command] = status
+        return status
 
-            if remote_command.returncode != 0:
-                raise ForkRebase('Failed to run \'git remote\'.\n%s' % stderr)
+    def get_config(self, key):
+        """
+        Returns the value of a git config key, or None if it is not set
+        """
+        try:
+            output = self.run_git(
+                ['config', '--get', key],
+                stdout_only=True
+            ).output
+        except ForkRebase:
+            return None
+        return output[-1] if output else None
+
+    def get_clone_filter(self):
+        """
+        Returns the partial clone filter of the fork, or None if all objects
+        are fetched
+        """
+        return self.get_config('remote.origin.partialclonefilter')
 
-        except CalledProcessError:
-            raise ForkRebase('Could not find the current remote.')
-        self.remotes = None
-        self.get_remotes()
-        os.chdir(self.basedir)
+    def is_shallow(self):
+        """
+        Returns True if the history of the fork has been truncated
+        """
+        status = self.run_git(
+            ['rev-parse', '--is-shallow-repository'],
+            stdout_only=True
+        )
+        return status.output[-1] == 'true'
 
-    def push_master(self):
+    def has_merge_base(self, ref):
         """
-        Pushs master against upstream/master
+        Returns True if master and the given ref have a common ancestor
         """
-        os.chdir(self.dirname)
         try:
-            # Run the git push command
-            push_command = Popen(
-                ['git', 'push', '-f', 'origin', 'master'],
-                stdout=PIPE,
-                stderr=PIPE
-            )
-            (stdout, stderr) = push_command.communicate()[:2]
+            self.run_git(['merge-base', 'master', ref], stdout_only=True)
+        except ForkRebase:
+            return False
+        return True
 
-            if push_command.returncode != 0:
-                raise ForkRebase('Failed to run \'git push\'.\n%s' % stderr)
+    def deepen_to_merge_base(self, ref, progress=None):
+        """
+        Fetch more history for a shallow fork until master and the given
+        remote branch have a common ancestor, so that rebasing and pushing
+        do not run into the truncated history
 
-        except CalledProcessError:
-            raise ForkPush('Could not find the current push.')
-        os.chdir(self.basedir)
+        The truncated history is usually master's own, which only origin
+        has, so origin is deepened before the remote of the branch. Raises
+        ForkRebase if there is no common ancestor even with all the history.
+        """
+        remotes = ['origin']
+        if ref.split('/')[0] != 'origin':
+            remotes.append(ref.split('/')[0])
+
+        fetches = [
+            ['--deepen=%d' % (DEEPEN_DEPTH * 2**attempt), remote]
+            for attempt in range(DEEPEN_ATTEMPTS) for remote in remotes
+        ]
+
+        # Give up on keeping the history short
+        fetches += [['--unshallow', remote] for remote in remotes]
+
+        for arguments in fetches:
+            if self.has_merge_base(ref):
+                return
+            if not self.is_shallow():
+                break
+            self.run_git(['fetch', '--progress'] + arguments, progress)
+
+        if not self.has_merge_base(ref):
+            raise ForkRebase(
+                'master and %s of %s have no common history' % (ref, self.dirname)
+            )
 
-    def update_submodules(self):
+    @classmethod
+    def clone(cls, basedir, dirname, url, clone_filter=None, depth=None,
+              branch=None, progress=None):
         """
-        Updates submodules
+        Clone a repository and return it as a fork
+
+        clone_filter is a partial clone filter such as blob:none
+        depth is the number of commits of history to fetch
+        """
+        arguments = ['clone', '--progress']
+        if clone_filter:
+            arguments.append('--filter=%s' % clone_filter)
+        if depth:
+            arguments += ['--depth=%d' % depth, '--no-single-branch']
+        if branch:
+            arguments += ['--branch', branch]
+
+        run_git(arguments + [url, dirname], basedir, progress)
+        return cls(basedir, dirname)
+
+    def convert(self, clone_filter=None, depth=None, progress=None):
         """
-        os.chdir(self.dirname)
+        Replace the fork with a partial and/or shallow clone of its origin
 
-        try:
-            # Run the git submodule command
-            submodule_command = Popen(
-                ['git', 'submodule', 'init'],
-                stdout=PIPE,
-                stderr=PIPE
+        The new clone is made next to the fork and only swapped in once it
+        has been set up, so a failure leaves the fork as it was. Branches,
+        tags, local config, hooks, info files and submodule repositories
+        are carried across. Reflogs and other git caches are not.
+        """
+        # Refuse to throw away anything that only exists in this clone
+        if 'origin' not in self.get_remotes():
+            raise ForkRebase('Fork %s has no origin remote' % self.dirname)
+
+        if not os.path.isdir(os.path.join(self.dirname, '.git')):
+            raise ForkRebase(
+                'Fork %s keeps its repository outside .git' % self.dirname
+            )
+
+        if self.run_git(
+                ['status', '--porcelain', '--ignored'],
+                stdout_only=True
+        ).output:
+            raise ForkRebase(
+                'Fork %s has uncommitted, untracked or ignored files'\
+                % self.dirname
+            )
+
+        if len([
+                line for line in self.run_git(
+                    ['worktree', 'list', '--porcelain'],
+                    output_lines=None,
+                    stdout_only=True
+                ).output
+                if line.startswith('worktree ')
+        ]) > 1:
+            raise ForkRebase('Fork %s has linked worktrees' % self.dirname)
+
+        # Stashes, notes and the like are not copied across. Tags are, if
+        # the remotes have them, which is checked once the clone is made.
+        tags = self.list_refs('refs/tags')
+        other_refs = [
+            ref for ref in self.list_refs()\
+            if not ref.startswith(
+                ('refs/heads/', 'refs/remotes/', 'refs/tags/')
+            )
+        ]
+        if other_refs:
+            raise ForkRebase(
+                'Fork %s has refs that would be lost: %s'\
+                % (self.dirname, ', '.join(other_refs[:5]))
             )
-            (stdout, stderr) = submodule_command.communicate()[:2]
 
-            if submodule_command.returncode != 0:
-                raise ForkRebase('Failed to run \'git submodule init\'.\n%s' % stderr)
+        if self.run_git(
+                ['rev-list', '--max-count=1', '--branches', '--not',
+                 '--remotes'],
+                stdout_only=True
+        ).output:
+            raise ForkRebase(
+                'Fork %s has commits that are not on any remote' % self.dirname
+            )
 
-        except CalledProcessError:
-            raise ForkRebase('Could not initialize submodules')
+        branches = self.list_refs('refs/heads')
+
+        parentdir = os.path.dirname(self.dirname)
+        newdir = tempfile.mkdtemp(
+            prefix='.%s.' % os.path.basename(self.dirname),
+            dir=parentdir
+        )
 
         try:
-            # Run the git submodule command
-            submodule_command = Popen(
-                ['git', 'submodule', 'update'],
-                stdout=PIPE,
-                stderr=PIPE
+            # get_remotes gives the push URLs, so clone from the fetch URL
+            fork = RepoFork.clone(
+                parentdir,
+                os.path.basename(newdir),
+                self.get_config('remote.origin.url'),
+                clone_filter,
+                depth,
+                self.get_current_branch(),
+                progress
             )
-            (stdout, stderr) = submodule_command.communicate()[:2]
 
-            if submodule_command.returncode != 0:
-                raise ForkRebase('Failed to run \'git submodule update\'.\n%s' % stderr)
+            # Bring across the other remotes
+            remotes = ['origin']
+            for name in sorted(self.get_remotes()):
+                if name != 'origin':
+                    remotes.append(name)
+                    fork.create_remote(
+                        name,
+                        self.get_config('remote.%s.url' % name)
+                    )
+                    if depth:
+                        fork.run_git(
+                            ['fetch', '--progress', '--depth=%d' % depth, name],
+                            progress
+                        )
+                    else:
+                        fork.fetch_remote(name, progress)
+
+            # Put the local branches back where they were
+            for name, commit in branches.items():
+                if depth:
+                    fork.fetch_commit(remotes, name, commit, depth, progress)
+                if name == fork.get_current_branch():
+                    fork.run_git(['reset', '--hard', commit])
+                else:
+                    fork.run_git(['branch', '-f', name, commit])
 
-        except CalledProcessError:
-            raise ForkRebase('Could not initialize submodules')
-        os.chdir(self.basedir)
+            if fork.list_refs('refs/heads') != branches:
+                raise ForkRebase(
+                    'The branches of the new clone of %s do not match'\
+                    % self.dirname
+                )
 
-    def rebase_master(self):
+            lost_tags = [
+                tag for tag, commit in sorted(tags.items())\
+                if fork.list_refs('refs/tags').get(tag) != commit
+            ]
+            if lost_tags:
+                raise ForkRebase(
+                    'Fork %s has tags that are not on its remotes, or are '\
+                    'beyond --depth: %s'\
+                    % (self.dirname, ', '.join(lost_tags[:5]))
+                )
+
+            self.copy_git_state(fork)
+            if os.path.isdir(os.path.join(fork.dirname, '.git', 'modules')):
+                fork.update_submodules(progress)
+
+        except:
+            # Leave nothing behind, whatever went wrong
+            shutil.rmtree(newdir, ignore_errors=True)
+            raise
+
+        # Swap the new clone in place of the old one
+        olddir = '%s.full' % newdir
+        os.rename(self.dirname, olddir)
+        try:
+            os.rename(newdir, self.dirname)
+        except:
+            os.rename(olddir, self.dirname)
+            shutil.rmtree(newdir, ignore_errors=True)
+            raise
+
+        # The conversion has worked even if the old clone cannot be removed
+        try:
+            shutil.rmtree(olddir)
+        except OSError as error:
+            print(
+                'Warning: could not remove the old clone %s: %s'\
+                % (olddir, error),
+                file=sys.stderr
+            )
+
+        self.remotes = None
+        self.get_remotes()
+
+    def copy_git_state(self, fork):
         """
-        Rebases master against upstream/master
+        Copy the local config, hooks, info files and submodule repositories
+        of this fork into a new clone of it
+
+        The settings that make the new clone partial are kept, and the rest
+        of the config is replaced with this fork's, so remotes keep their
+        push URLs and branches their upstreams.
         """
-        os.chdir(self.dirname)
         try:
-            # Run the git rebase command
-            rebase_command = Popen(
-                ['git', 'rebase', 'upstream/master'],
-                stdout=PIPE,
-                stderr=PIPE
-            )
-            (stdout, stderr) = rebase_command.communicate()[:2]
+            settings = fork.run_git(
+                ['config', '--local', '--get-regexp',
+                 r'^(core\.repositoryformatversion|extensions\..*'\
+                 r'|remote\..*\.(promisor|partialclonefilter))$'],
+                output_lines=None,
+                stdout_only=True
+            ).output
+        except ForkRebase:
+            settings = []
+
+        olddir = os.path.join(self.dirname, '.git')
+        newdir = os.path.join(fork.dirname, '.git')
+
+        shutil.copyfile(
+            os.path.join(olddir, 'config'),
+            os.path.join(newdir, 'config')
+        )
+        for line in settings:
+            fork.run_git(['config'] + line.split(' ', 1))
+
+        for dirname in ['hooks', 'info', 'modules']:
+            if os.path.isdir(os.path.join(olddir, dirname)):
+                shutil.copytree(
+                    os.path.join(olddir, dirname),
+                    os.path.join(newdir, dirname),
+                    symlinks=True,
+                    dirs_exist_ok=True
+                )
 
-            if rebase_command.returncode != 0:
-                raise ForkRebase('Failed to run \'git rebase\'.\n%s' % stderr)
+        fork.remotes = None
+        fork.get_remotes()
 
-        except CalledProcessError:
-            raise ForkRebase('Could not rebase master against upstream')
-        os.chdir(self.basedir)
+    def list_refs(self, prefix=None):
+        """
+        Returns a dict of refs and the objects they point to
 
-    def fetch_remote(self, name):
+        If a prefix such as refs/heads is given, only refs under it are
+        listed, with the prefix removed from their names.
         """
-        Run fetch for the remote repo
+        arguments = ['for-each-ref', '--format=%(refname) %(objectname)']
+        if prefix:
+            arguments.append(prefix)
+
+        refs = {}
+        for line in self.run_git(
+                arguments,
+                output_lines=None,
+                stdout_only=True
+        ).output:
+            (name, commit) = line.rsplit(' ', 1)
+            if prefix:
+                name = name[len(prefix) + 1:]
+            refs[name] = commit
+        return refs
+
+    def fetch_commit(self, remotes, branch, commit, depth, progress=None):
         """
-        os.chdir(self.dirname)
-        try:
-            # Run the git fetch command
-            remote_command = Popen(
-                ['git', 'fetch', '--prune', name],
-                stdout=PIPE,
-                stderr=PIPE
+        Fetch the commit a branch is at, with depth commits of history, from
+        the first of the remotes that has it
+
+        A shallow clone only has the last few commits of each remote branch,
+        so a local branch that is further behind needs fetching separately.
+        """
+        for remote in remotes:
+            try:
+                self.run_git(
+                    ['fetch', '--progress', '--depth=%d' % depth, remote,
+                     commit],
+                    progress
+                )
+                return
+            except ForkRebase:
+                continue
+
+        raise ForkRebase(
+            'Branch %s of %s is at %s, which is more than %d commits behind '\
+            'its remote and could not be fetched on its own. Convert with a '\
+            'larger --depth, or update the branch first.'\
+            % (branch, self.dirname, commit, depth)
+        )
+
+    def create_remote(self, name, repopath):
+        """
+        Defines a remote repository
+        """
+        self.run_git(['remote', 'add', name, repopath])
+
+        # Fetch from the new remote with the same filter as origin
+        clone_filter = self.get_clone_filter()
+        if clone_filter:
+            self.run_git(
+                ['config', 'remote.%s.promisor' % name, 'true']
+            )
+            self.run_git(
+                ['config', 'remote.%s.partialclonefilter' % name, clone_filter]
             )
-            (stdout, stderr) = remote_command.communicate()[:2]
 
-            if remote_command.returncode != 0:
-                raise ForkRebase('Failed to run \'git fetch\'.\n%s' % stderr)
+        self.remotes = None
+        self.get_remotes()
+
+    def push_master(self, progress=None):
+        """
+        Pushs master against upstream/master
+        """
+        self.run_git(
+            ['push', '--progress', '-f', 'origin', 'master'],
+            progress
+        )
+
+    def update_submodules(self, progress=None, depth=None, clone_filter=None):
+        """
+        Updates submodules
+
+        depth and clone_filter are used when cloning new submodules
+        """
+        arguments = ['submodule', 'update', '--progress']
+        if depth:
+            arguments.append('--depth=%d' % depth)
+        if clone_filter:
+            arguments += ['--init', '--filter=%s' % clone_filter]
+
+        self.run_git(['submodule', 'init'])
+        self.run_git(arguments, progress)
+
+    def rebase_master(self):
+        """
+        Rebases master against upstream/master
+        """
+        try:
+            self.run_git(['rebase', 'upstream/master'])
+        except ForkRebase:
+            # Leave the fork as it was rather than part way through
+            try:
+                self.run_git(['rebase', '--abort'])
+            except ForkRebase:
+                pass
+            raise
 
-        except CalledProcessError:
-            raise ForkRebase('Could not find the current remote.')
-        os.chdir(self.basedir)
+    def fetch_remote(self, name, progress=None):
+        """
+        Run fetch for the remote repo
+        """
+        self.run_git(['fetch', '--progress', '--prune', name], progress)
 
     def __str__(self):
         """
@@ -299,6 +815,12 @@ class App(object):
         self.sorted_fork_names = []
         self.find_forks()
 
+        # Convert the forks to partial or shallow clones instead of
+        # running the GUI
+        if self.args.convert:
+            self.convert_forks()
+            self.quit()
+
         # Find the common upstream, if there is one
         self.upstream = None
         self.find_upstream()
@@ -316,10 +838,23 @@ class App(object):
 
         # Initialise GUI data elements
         self.repotable = None
-        self.tablelines = {}
+        self.insert_job = None
+        self.pending_rows = []
+        self.name_filter = StringVar(self.root)
+        self.state_filter = StringVar(self.root, value='all')
+        self.summary = StringVar(self.root)
         self.quit_button = None
         self.rebase_button = None
 
+        # State and status message of each fork, and the number of forks in
+        # each state
+        self.fork_states = dict.fromkeys(self.sorted_fork_names, 'pending')
+        self.fork_messages = dict.fromkeys(self.sorted_fork_names, '')
+        self.state_counts = dict.fromkeys(FORK_STATES, 0)
+        self.state_counts['pending'] = len(self.sorted_fork_names)
+        self.rebase_started = None
+        self.rebase_finished = 0
+
         # Run the GUI
         self.run()
 
@@ -329,20 +864,114 @@ class App(object):
 
     def find_forks(self):
         """
-        Finds the directories under the current working directory
-        and checks that they are git repositories
+        Finds the git repositories under the base directory, down to
+        --max-depth directories deep, and creates a RepoFork for each
         """
-        # Get a list of the directories within the base dir and create a new
-        # RepoFork object.
-        for dirname in [\
-            dirname for dirname in os.listdir()\
-            if os.path.isdir(dirname)\
-        ]:
-            self.forks[dirname] = RepoFork(self.basedir, dirname)
+        with ThreadPoolExecutor(self.args.jobs) as executor:
+            # Scan each level of directories in parallel
+            dirnames = []
+            level = ['']
+            for depth in range(self.args.max_depth):
+                subdirs = []
+                for (repos, others) in executor.map(self.scan_dir, level):
+                    dirnames += repos
+                    subdirs += others
+                level = subdirs
+
+            # Reading the remotes and branch of a fork runs git, so create
+            # the RepoFork objects in parallel too
+            futures = {}
+            for dirname in dirnames:
+                if self.is_included(dirname):
+                    futures[dirname] = executor.submit(
+                        RepoFork,
+                        self.basedir,
+                        dirname
+                    )
+
+            for dirname, future in futures.items():
+                try:
+                    self.forks[dirname] = future.result()
+                except ForkRebase as error:
+                    print(
+                        'Skipping %s: %s' % (dirname, error),
+                        file=sys.stderr
+                    )
 
         # Create a sorted list of the fork names
         self.sorted_fork_names = sorted(self.forks.keys())
 
+    def scan_dir(self, dirname):
+        """
+        Returns the git repositories and the other directories within a
+        directory, as paths relative to the base directory
+
+        Hidden and excluded directories are left out. A directory is taken
+        to be a git repository if it contains .git, without running git.
+        """
+        repos = []
+        subdirs = []
+
+        try:
+            with os.scandir(os.path.join(self.basedir, dirname)) as entries:
+                for entry in entries:
+                    path = os.path.join(dirname, entry.name)
+                    if entry.name.startswith('.') or not entry.is_dir()\
+                            or self.is_excluded(path):
+                        continue
+
+                    if os.path.lexists(os.path.join(entry.path, '.git')):
+                        repos.append(path)
+                    else:
+                        subdirs.append(path)
+
+        except OSError as error:
+            print('Skipping %s: %s' % (dirname, error), file=sys.stderr)
+
+        return (repos, subdirs)
+
+    def is_excluded(self, dirname):
+        """
+        Returns True if a directory matches any of the --exclude globs
+        """
+        return any(fnmatch(dirname, glob) for glob in self.args.exclude)
+
+    def is_included(self, dirname):
+        """
+        Returns True if a fork matches any of the --include globs, or there
+        are none
+        """
+        return not self.args.include\
+            or any(fnmatch(dirname, glob) for glob in self.args.include)
+
+    def convert_forks(self):
+        """
+        Converts each of the forks to a partial and/or shallow clone,
+        reporting progress on the command line
+        """
+        def report(progress):
+            """
+            Show the progress of a git command
+            """
+            sys.stdout.write('\r    %s\033[K' % progress)
+            sys.stdout.flush()
+
+        for name in self.sorted_fork_names:
+            fork = self.forks[name]
+            before = disk_usage(fork.dirname)
+            print('Converting %s' % name)
+
+            try:
+                fork.convert(self.args.filter, self.args.depth, report)
+            except (ForkRebase, OSError) as error:
+                print('\r    Failed: %s\033[K' % error)
+                continue
+
+            print(
+                '\r    Reduced from %.1f MiB to %.1f MiB\033[K'\
+                % (before / 2**20, disk_usage(fork.dirname) / 2**20)
+            )
+
     def define_known_repos(self):
         """
         Returns a list of known repos that are managed, and their upstream
@@ -418,9 +1047,83 @@ class App(object):
                 'url = <url to upstream git repo>'
         )
 
+        # Where to look for forks within the base directory
+        parser.add_argument(
+            '--max-depth',
+            type=int,
+            default=1,
+            help=\
+                'How many directories deep to look for forks, e.g. 3 for '\
+                'term/student/repo.'
+        )
+
+        parser.add_argument(
+            '--include',
+            action='append',
+            default=[],
+            help=\
+                'Only use forks whose path relative to the base directory, '\
+                'such as term/student/repo, matches this glob. * also '\
+                'matches /. May be given more than once.'
+        )
+
+        parser.add_argument(
+            '--exclude',
+            action='append',
+            default=[],
+            help=\
+                'Skip directories whose path relative to the base directory '\
+                'matches this glob. A plain name only matches at the top '\
+                'level, while * also matches /, so */name matches at any '\
+                'depth. May be given more than once.'
+        )
+
+        parser.add_argument(
+            '-j',
+            '--jobs',
+            type=int,
+            help='Number of directories to scan at once.'
+        )
+
+        # History and objects to fetch for the forks
+        parser.add_argument(
+            '--depth',
+            type=int,
+            help=\
+                'Number of commits of history to keep when converting '\
+                'forks and cloning submodules.'
+        )
+
+        parser.add_argument(
+            '--filter',
+            help=\
+                'Partial clone filter, such as blob:none, to use when '\
+                'converting forks and cloning submodules.'
+        )
+
+        parser.add_argument(
+            '--convert',
+            action='store_true',
+            help=\
+                'Replace each fork with a partial and/or shallow clone '\
+                'using --filter and --depth, instead of running the GUI.'
+        )
+
         # Actually read in the arguments from the command line
         self.args = parser.parse_args()
 
+        if self.args.convert and not (self.args.filter or self.args.depth):
+            raise ForkRebase('--convert needs --filter and/or --depth\n')
+
+        if self.args.depth is not None and self.args.depth < 1:
+            raise ForkRebase('--depth must be at least 1\n')
+
+        if self.args.max_depth < 1:
+            raise ForkRebase('--max-depth must be at least 1\n')
+
+        if self.args.jobs is not None and self.args.jobs < 1:
+            raise ForkRebase('--jobs must be at least 1\n')
+
         # Check that base directory exists
         if not os.path.isdir(self.args.basedir):
             raise ForkRebase(
@@ -450,23 +1153,154 @@ class App(object):
         """
         Updates the status of the given repo name in the repotable
         """
-        self.repotable.set(
-            self.tablelines[name],
-            'status',
-            status
-        )
+        self.fork_messages[name] = status
+        if self.repotable.exists(name):
+            self.repotable.set(name, 'status', status)
         self.root.update()
 
-    def set_line_colour(self, name, colour):
+    def progress_reporter(self, name, message):
         """
-        Set the colour of a line in the repo table
+        Returns a callback that shows git progress in the status of the given
+        repo name
         """
-        self.repotable.tag_configure(
-            name,
-            foreground=colour
-        )
+        def report(progress):
+            """
+            Show the progress of a git command
+            """
+            self.set_repo_status(
+                name,
+                '%s: %s (%.0fs)' % (message, progress, progress.elapsed())
+            )
+
+        return report
+
+    def set_fork_state(self, name, state):
+        """
+        Set the state of a fork, which colours its line in the repo table
+        and is counted in the summary bar
+        """
+        self.state_counts[self.fork_states[name]] -= 1
+        self.state_counts[state] += 1
+        self.fork_states[name] = state
+
+        if state in ('ok', 'failed'):
+            self.rebase_finished += 1
+
+        if self.repotable.exists(name):
+            if self.matches_filter(name):
+                self.repotable.item(name, tags=(state, ))
+            else:
+                self.repotable.delete(name)
+        elif self.matches_filter(name) and not self.is_pending_row(name):
+            # Keep the lines in the same order as the fork names
+            self.insert_row(
+                name,
+                bisect(self.repotable.get_children(), name)
+            )
+
+        self.update_summary()
         self.root.update()
 
+    def update_summary(self):
+        """
+        Show the number of forks in each state and the overall throughput
+        """
+        summary = '   '.join(
+            '%s: %d' % (state.capitalize(), self.state_counts[state])
+            for state in FORK_STATES
+        )
+
+        if self.rebase_started:
+            elapsed = time.time() - self.rebase_started
+            summary += '   |   %d forks in %.0fs (%.1f forks/min)'\
+                % (
+                    self.rebase_finished,
+                    elapsed,
+                    60 * self.rebase_finished / max(elapsed, 1)
+                )
+
+        self.summary.set(summary)
+
+    def matches_filter(self, name):
+        """
+        Returns True if a fork matches the name and status filters
+        """
+        return self.name_filter.get().strip().lower() in name.lower()\
+            and self.state_filter.get() in ('all', self.fork_states[name])
+
+    def filtered_fork_names(self):
+        """
+        Returns the sorted fork names that match the name and status filters
+        """
+        return [
+            name for name in self.sorted_fork_names\
+            if self.matches_filter(name)
+        ]
+
+    def apply_filter(self, *args):
+        """
+        Rebuild the repo table with the forks that match the filters
+        """
+        if self.insert_job:
+            self.root.after_cancel(self.insert_job)
+            self.insert_job = None
+
+        self.repotable.delete(*self.repotable.get_children())
+        self.insert_rows(self.filtered_fork_names())
+
+    def is_pending_row(self, name):
+        """
+        Returns True if the line for a fork is still waiting to be inserted
+        """
+        index = bisect_left(self.pending_rows, name)
+        return index < len(self.pending_rows)\
+            and self.pending_rows[index] == name
+
+    def insert_rows(self, names):
+        """
+        Insert lines into the repo table for the given sorted fork names
+
+        Lines are inserted ROW_BATCH at a time, with the rest scheduled for
+        when the GUI is idle, so that the window opens without waiting for
+        every line. Every fork that matches the filters still gets a line in
+        the Treeview.
+        """
+        self.insert_job = None
+        self.pending_rows = names[ROW_BATCH:]
+
+        # Forks may have changed state since they were scheduled, and lines
+        # inserted since then may belong anywhere, so keep the lines sorted
+        lines = list(self.repotable.get_children())
+        for name in names[:ROW_BATCH]:
+            if self.matches_filter(name) and not self.repotable.exists(name):
+                index = bisect(lines, name)
+                self.insert_row(name, index)
+                lines.insert(index, name)
+
+        if self.pending_rows:
+            self.insert_job = self.root.after_idle(
+                self.insert_rows,
+                self.pending_rows
+            )
+
+    def insert_row(self, name, index):
+        """
+        Insert the line for a fork into the repo table at the given index
+        """
+        fork = self.forks[name]
+        self.repotable.insert(
+            '',
+            index,
+            iid=name,
+            text=name,
+            values=(
+                fork.dirname,
+                fork.get_remotes().get('origin', ''),
+                self.fork_messages[name]
+            ),
+            tags=(self.fork_states[name], )
+        )
+
     def disable_buttons(self):
         """
         Disable Quit and Rebase Buttons
@@ -488,76 +1322,106 @@ class App(object):
         # Temporarily disable buttons
         self.disable_buttons()
 
-        # Find the list of selected items
-        selected_items = self.repotable.selection()
-        selected_repo_names = []
+        # Find the list of selected items, rows are identified by fork name
+        selected_repo_names = list(self.repotable.selection())
 
-        if len(selected_items) != 0:
-            # Only rebase the selected repos
-            for item in selected_items:
-                selected_repo_names.append(self.repotable.item(item)['text'])
-        else:
-            # Rebase all repos
-            selected_repo_names = self.sorted_fork_names
+        if len(selected_repo_names) == 0:
+            # Rebase all repos that match the filters
+            selected_repo_names = self.filtered_fork_names()
 
-        # Set status a colour
+        # Reset the status of the forks to be rebased
         for name in selected_repo_names:
-            self.set_line_colour(name, 'black')
+            self.set_fork_state(name, 'pending')
             self.set_repo_status(name, '')
 
+        # Only forks finished in this run count towards the throughput
+        self.rebase_started = time.time()
+        self.rebase_finished = 0
+
         for name in selected_repo_names:
             fork = self.forks[name]
-            self.set_repo_status(name, 'Starting Rebase')
 
-            # Create an upstream if we need one
-            if 'upstream' not in fork.get_remotes():
-                self.set_repo_status(name, 'Creating upstream')
-                try:
-                    fork.create_remote('upstream', self.upstream)
-                except ForkRebase:
-                    self.set_line_colour(name, 'red')
-                    continue
-
-            # Fetch latest db for upstream and origin
-            for remote in ['upstream', 'origin']:
-                self.set_repo_status(name, 'Fetching DB for %s' % remote)
-                try:
-                    fork.fetch_remote(remote)
-                except ForkRebase:
-                    self.set_line_colour(name, 'red')
-                    continue
-
-            # Rebase the master branch against upstream master
-            self.set_repo_status(name, 'Rebasing against upstream/master')
-            try:
-                fork.rebase_master()
-            except ForkRebase:
-                self.set_line_colour(name, 'red')
-                continue
-
-            # Update submodules
-            self.set_repo_status(name, 'Updated submodules')
-            try:
-                fork.update_submodules()
-            except ForkRebase:
-                self.set_line_colour(name, 'red')
+            # Forks without an origin have nowhere to push to
+            if 'origin' not in fork.get_remotes():
+                self.set_repo_status(name, 'No origin remote')
+                self.set_fork_state(name, 'skipped')
                 continue
 
-            # Push changes to fork
-            self.set_repo_status(name, 'Pushing master to origin repo')
+            self.set_fork_state(name, 'running')
             try:
-                fork.push_master()
+                self.rebase_fork(name)
             except ForkRebase:
-                self.set_line_colour(name, 'red')
+                self.set_fork_state(name, 'failed')
                 continue
 
-            self.set_repo_status(name, 'Complete')
-            self.set_line_colour(name, 'green')
-            self.root.update()
+            self.set_repo_status(
+                name,
+                'Complete in %.1fs'\
+                % sum(timing.elapsed() for timing in fork.timings.values())
+            )
+            self.set_fork_state(name, 'ok')
 
         # Reenable buttons
         self.enable_buttons()
 
+    def rebase_fork(self, name):
+        """
+        Rebases a single fork, raising ForkRebase if any step fails
+        """
+        fork = self.forks[name]
+        self.set_repo_status(name, 'Starting Rebase')
+        fork.timings.clear()
+
+        # Create an upstream if we need one
+        if 'upstream' not in fork.get_remotes():
+            self.set_repo_status(name, 'Creating upstream')
+            fork.create_remote('upstream', self.upstream)
+
+        # Fetch latest db for upstream and origin
+        for remote in ['upstream', 'origin']:
+            self.set_repo_status(name, 'Fetching DB for %s' % remote)
+            fork.fetch_remote(
+                remote,
+                self.progress_reporter(
+                    name,
+                    'Fetching DB for %s' % remote
+                )
+            )
+
+        # Shallow forks need the history back to where master meets the
+        # remotes before it can be rebased and pushed
+        if fork.is_shallow():
+            for ref in ['upstream/master', 'origin/master']:
+                self.set_repo_status(name, 'Deepening history for %s' % ref)
+                fork.deepen_to_merge_base(
+                    ref,
+                    self.progress_reporter(
+                        name,
+                        'Deepening history for %s' % ref
+                    )
+                )
+
+        # Rebase the master branch against upstream master
+        self.set_repo_status(name, 'Rebasing against upstream/master')
+        fork.rebase_master()
+
+        # Update submodules
+        self.set_repo_status(name, 'Updating submodules')
+        fork.update_submodules(
+            self.progress_reporter(name, 'Updating submodules'),
+            self.args.depth,
+            self.args.filter
+        )
+
+        # Push changes to fork
+        self.set_repo_status(name, 'Pushing master to origin repo')
+        fork.push_master(
+            self.progress_reporter(
+                name,
+                'Pushing master to origin repo'
+            )
+        )
+
 
     def double_click(self, event):
         """
@@ -598,11 +1462,31 @@ class App(object):
             text='Upstream Repo: %s' % self.upstream
         ).grid(column=1, columnspan=1, row=1, sticky=W)
 
+        # Filter the forks by name and state
+        filterframe = ttk.Frame(mainframe)
+        filterframe.grid(column=1, columnspan=1, row=2, sticky=(W, E))
+        ttk.Label(filterframe, text='Filter:').grid(column=1, row=1, sticky=W)
+        ttk.Entry(
+            filterframe,
+            textvariable=self.name_filter,
+            width=40
+        ).grid(column=2, row=1, sticky=W)
+        ttk.Label(filterframe, text='Status:').grid(column=3, row=1, sticky=W)
+        ttk.Combobox(
+            filterframe,
+            textvariable=self.state_filter,
+            values=('all', ) + FORK_STATES,
+            state='readonly',
+            width=10
+        ).grid(column=4, row=1, sticky=W)
+        self.name_filter.trace_add('write', self.apply_filter)
+        self.state_filter.trace_add('write', self.apply_filter)
+
         self.repotable = ttk.Treeview(
             mainframe,
             columns=('path', 'repository', 'status')
         )
-        self.repotable.grid(column=1, columnspan=1, row=2, sticky=(W, E))
+        self.repotable.grid(column=1, columnspan=1, row=3, sticky=(W, E))
         self.repotable.column('path', anchor='w', width=300)
         self.repotable.heading('path', text='Path')
         self.repotable.column('repository', anchor='w', width=400)
@@ -611,20 +1495,27 @@ class App(object):
         self.repotable.heading('status', text='Status')
         self.repotable.bind('<Double-1>', self.double_click)
 
-        # Insert a line for each of the forks
-        for name in sorted(self.forks.keys()):
-            fork = self.forks[name]
-            self.tablelines[name] = self.repotable.insert(
-                '',
-                'end',
-                text=name,
-                values=(
-                    fork.dirname,
-                    fork.get_remotes()['origin'],
-                    ''
-                ),
-                tags=(name, )
-            )
+        scrollbar = ttk.Scrollbar(
+            mainframe,
+            orient=VERTICAL,
+            command=self.repotable.yview
+        )
+        scrollbar.grid(column=2, row=3, sticky=(N, S))
+        self.repotable.configure(yscrollcommand=scrollbar.set)
+
+        # Colour the lines by the state of the fork
+        for state, colour in STATE_COLOURS.items():
+            self.repotable.tag_configure(state, foreground=colour)
+
+        # Insert the lines for the forks as the GUI becomes idle
+        self.insert_rows(self.sorted_fork_names)
+
+        # Summary of the fork states
+        ttk.Label(
+            mainframe,
+            textvariable=self.summary
+        ).grid(column=1, columnspan=1, row=4, sticky=W)
+        self.update_summary()
 
         # ttk.Label(
         #     mainframe,
@@ -712,14 +1603,14 @@ class App(object):
             text='Quit',
             command=self.quit
         )
-        self.quit_button.grid(column=1, row=3, sticky=W)
+        self.quit_button.grid(column=1, row=5, sticky=W)
 
         self.rebase_button = ttk.Button(
             mainframe,
             text='Rebase',
             command=self.rebase
         )
-        self.rebase_button.grid(column=1, row=3, sticky=E)
+        self.rebase_button.grid(column=1, row=5, sticky=E)
 
         # for x in range(2):
         #     mainframe.columnconfigure(x, weight=1)
@@ -0,0 +1,413 @@
+"""
+Tests for rebase_forks
+"""
+import argparse
+import os
+import time
+from subprocess import check_output
+
+import pytest
+
+import rebase_forks
+from rebase_forks import (
+    App, FORK_STATES, ForkRebase, GitProgress, MAX_LINE_LENGTH, RepoFork,
+    split_output
+)
+
+def parse(*lines):
+    """
+    Returns a GitProgress that has parsed the given lines
+    """
+    progress = GitProgress('git fetch')
+    for line in lines:
+        progress.parse(line)
+    return progress
+
+def test_parse_counts():
+    progress = parse('remote: Counting objects:  45% (450/1000)')
+    assert progress.phase == 'Counting objects'
+    assert (progress.percent, progress.done, progress.total) == (45, 450, 1000)
+    assert progress.transferred is None and progress.rate is None
+
+def test_parse_transfer():
+    progress = parse(
+        'Receiving objects:  45% (450/1000), 1.20 MiB | 2.40 MiB/s'
+    )
+    assert progress.transferred == '1.20 MiB'
+    assert progress.rate == '2.40 MiB/s'
+    assert str(progress) ==\
+        'Receiving objects 45% (450/1000), 1.20 MiB | 2.40 MiB/s'
+
+def test_parse_bytes():
+    progress = parse(
+        'Writing objects:  50% (1/2), 300 bytes | 300.00 KiB/s',
+        'Writing objects: 100% (2/2), 1 byte | 1 byte/s, done.'
+    )
+    assert progress.transferred == '1 byte'
+    assert progress.rate == '1 byte/s'
+
+def test_parse_new_phase_resets_transfer():
+    progress = parse(
+        'Receiving objects: 100% (2/2), 1.20 MiB | 2.40 MiB/s, done.',
+        'Resolving deltas:  50% (5/10)'
+    )
+    assert progress.phase == 'Resolving deltas'
+    assert progress.transferred is None and progress.rate is None
+
+def test_parse_other_output():
+    progress = GitProgress('git fetch')
+    assert not progress.parse('From github.com:example/repo')
+    assert str(progress) == ''
+
+def test_split_carriage_returns():
+    (lines, partial) = split_output(
+        b'',
+        b'Counting objects:  50% (1/2)\rCounting objects: 100% (2/2)\r\n'\
+        b'From x\nReceiving'
+    )
+    assert lines == [
+        'Counting objects:  50% (1/2)',
+        'Counting objects: 100% (2/2)',
+        'From x'
+    ]
+    assert partial == b'Receiving'
+
+def test_split_joins_partial_lines():
+    (lines, partial) = split_output(b'Receiving obj', b'ects: 1% (1/100)\r')
+    assert lines == ['Receiving objects: 1% (1/100)']
+    assert partial == b''
+
+def test_split_caps_lines():
+    (lines, partial) = split_output(b'', b'x' * (3 * MAX_LINE_LENGTH))
+    assert lines == [] and len(partial) == MAX_LINE_LENGTH
+
+    (lines, partial) = split_output(partial, b'y' * MAX_LINE_LENGTH + b'\n')
+    assert lines == ['y' * MAX_LINE_LENGTH]
+
+def git(cwd, *arguments):
+    """
+    Run git in a directory and return its output
+    """
+    return check_output(['git'] + list(arguments), cwd=str(cwd)).decode()
+
+def commit_file(repo, filename, contents):
+    """
+    Write a file in a repository and commit it
+    """
+    (repo / filename).write_text(contents)
+    git(repo, 'add', filename)
+    git(repo, 'commit', '-q', '-m', 'Change %s' % filename)
+
+@pytest.fixture
+def forks(tmp_path, monkeypatch):
+    """
+    Returns the base directory of a fork of an upstream repository, both
+    served from file:// remotes, with one commit of the fork's own
+    """
+    for name in ['AUTHOR', 'COMMITTER']:
+        monkeypatch.setenv('GIT_%s_NAME' % name, 'Test')
+        monkeypatch.setenv('GIT_%s_EMAIL' % name, 'test@example.com')
+
+    upstream = tmp_path / 'upstream'
+    git(tmp_path, 'init', '-q', '-b', 'master', str(upstream))
+    git(upstream, 'config', 'uploadpack.allowFilter', 'true')
+    for number in range(10):
+        commit_file(upstream, 'shared', '%d\n' % number)
+
+    git(tmp_path, 'clone', '-q', '--bare', str(upstream), 'origin.git')
+    git(tmp_path / 'origin.git', 'config', 'uploadpack.allowFilter', 'true')
+
+    basedir = tmp_path / 'base'
+    basedir.mkdir()
+    git(basedir, 'clone', '-q', 'file://%s/origin.git' % tmp_path, 'fork')
+    fork = basedir / 'fork'
+    git(fork, 'remote', 'add', 'upstream', 'file://%s' % upstream)
+    commit_file(fork, 'mine', 'mine\n')
+    git(fork, 'push', '-q', 'origin', 'master')
+
+    return basedir
+
+def test_rebase_shallow_fork(forks):
+    upstream = forks.parent / 'upstream'
+    fork = RepoFork(str(forks), 'fork')
+    fork.convert('blob:none', 1)
+    assert fork.is_shallow()
+
+    # Upstream changes a file that is older than the fork's history
+    commit_file(upstream, 'shared', 'changed\n')
+
+    for remote in ['upstream', 'origin']:
+        fork.fetch_remote(remote)
+    for ref in ['upstream/master', 'origin/master']:
+        fork.deepen_to_merge_base(ref)
+    fork.rebase_master()
+    fork.push_master()
+
+    assert git(forks / 'fork', 'log', '--format=%s', '-2').split('\n')[:2]\
+        == ['Change mine', 'Change shared']
+    assert git(forks.parent / 'origin.git', 'rev-parse', 'master')\
+        == git(forks / 'fork', 'rev-parse', 'master')
+
+def test_deepen_without_common_history(forks):
+    upstream = forks.parent / 'upstream'
+    git(upstream, 'checkout', '-q', '--orphan', 'unrelated')
+    git(upstream, 'rm', '-q', '-r', '-f', '.')
+    commit_file(upstream, 'other', 'other\n')
+    git(upstream, 'branch', '-q', '-M', 'master')
+
+    fork = RepoFork(str(forks), 'fork')
+    fork.convert(depth=1)
+    fork.fetch_remote('upstream')
+    with pytest.raises(ForkRebase):
+        fork.deepen_to_merge_base('upstream/master')
+
+def test_convert_keeps_config_and_hooks(forks):
+    fork = forks / 'fork'
+    git(fork, 'config', 'user.name', 'Fork Owner')
+    git(fork, 'config', 'remote.origin.pushurl', '/nowhere/origin.git')
+    git(fork, 'branch', '-q', '--track', 'topic', 'origin/master')
+    (fork / '.git' / 'hooks' / 'pre-push').write_text('#!/bin/sh\n')
+    (fork / '.git' / 'info' / 'exclude').write_text('*.o\n')
+
+    repo = RepoFork(str(forks), 'fork')
+    repo.convert('blob:none', 1)
+
+    assert repo.get_config('user.name') == 'Fork Owner'
+    assert repo.get_config('remote.origin.url')\
+        == 'file://%s/origin.git' % forks.parent
+    assert repo.get_config('remote.origin.pushurl') == '/nowhere/origin.git'
+    assert repo.get_config('branch.topic.merge') == 'refs/heads/master'
+    assert repo.get_clone_filter() == 'blob:none'
+    assert (fork / '.git' / 'hooks' / 'pre-push').read_text() == '#!/bin/sh\n'
+    assert (fork / '.git' / 'info' / 'exclude').read_text() == '*.o\n'
+
+def test_convert_refuses_stash(forks):
+    fork = forks / 'fork'
+    (fork / 'mine').write_text('changed\n')
+    git(fork, 'stash', '-q')
+
+    with pytest.raises(ForkRebase):
+        RepoFork(str(forks), 'fork').convert(depth=1)
+    assert 'stash@{0}' in git(fork, 'stash', 'list')
+    assert sorted(os.listdir(str(forks))) == ['fork']
+
+def test_get_config_empty_value(forks):
+    fork = RepoFork(str(forks), 'fork')
+    git(forks / 'fork', 'config', 'test.empty', '')
+    assert fork.get_config('test.empty') is None
+    assert fork.get_config('test.unset') is None
+
+class Table(object):
+    """
+    Stands in for the repo table Treeview, keeping only the line order
+    """
+
+    def __init__(self):
+        self.lines = []
+        self.tags = {}
+
+    def exists(self, name):
+        return name in self.lines
+
+    def get_children(self):
+        return tuple(self.lines)
+
+    def insert(self, parent, index, iid, text, values, tags):
+        assert iid not in self.lines
+        self.lines.insert(len(self.lines) if index == 'end' else index, iid)
+        self.tags[iid] = tags
+
+    def item(self, name, tags):
+        self.tags[name] = tags
+
+    def delete(self, *names):
+        for name in names:
+            self.lines.remove(name)
+
+    def set(self, name, column, value):
+        pass
+
+class Root(object):
+    """
+    Stands in for the Tk root, running idle callbacks when asked
+    """
+
+    def __init__(self):
+        self.idle = []
+
+    def update(self):
+        pass
+
+    def after_idle(self, function, *arguments):
+        self.idle.append((function, arguments))
+        return len(self.idle)
+
+    def after_cancel(self, job):
+        self.idle = []
+
+    def run_idle(self):
+        while self.idle:
+            (function, arguments) = self.idle.pop(0)
+            function(*arguments)
+
+class Variable(object):
+    """
+    Stands in for a Tk StringVar
+    """
+
+    def __init__(self, value=''):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+    def set(self, value):
+        self.value = value
+
+class Fork(object):
+    """
+    Stands in for a RepoFork
+    """
+    dirname = 'fork'
+
+    def get_remotes(self):
+        return {'origin': 'origin.git'}
+
+def make_app(count, state_filter='all'):
+    """
+    Returns an App with a fake table of count forks, without a display
+    """
+    names = ['fork%03d' % number for number in range(count)]
+    app = App.__new__(App)
+    app.sorted_fork_names = names
+    app.forks = dict((name, Fork()) for name in names)
+    app.repotable = Table()
+    app.root = Root()
+    app.insert_job = None
+    app.pending_rows = []
+    app.name_filter = Variable()
+    app.state_filter = Variable(state_filter)
+    app.summary = Variable()
+    app.fork_states = dict.fromkeys(names, 'pending')
+    app.fork_messages = dict.fromkeys(names, '')
+    app.state_counts = dict.fromkeys(FORK_STATES, 0)
+    app.state_counts['pending'] = count
+    app.rebase_started = None
+    app.rebase_finished = 0
+    return app
+
+def test_rows_inserted_in_batches(monkeypatch):
+    monkeypatch.setattr(rebase_forks, 'ROW_BATCH', 3)
+    app = make_app(10)
+    app.insert_rows(app.sorted_fork_names)
+    assert app.repotable.lines == app.sorted_fork_names[:3]
+
+    app.root.run_idle()
+    assert app.repotable.lines == app.sorted_fork_names
+
+def test_state_filter_follows_state_changes(monkeypatch):
+    monkeypatch.setattr(rebase_forks, 'ROW_BATCH', 3)
+    app = make_app(20, 'failed')
+    for name in app.sorted_fork_names[:8]:
+        app.set_fork_state(name, 'failed')
+    app.apply_filter()
+    assert app.repotable.lines == app.sorted_fork_names[:3]
+
+    # Neither line is in a pending batch, so both must appear now
+    app.set_fork_state('fork015', 'failed')
+    app.set_fork_state('fork009', 'failed')
+    # A line that is waiting for a batch goes back to pending
+    app.set_fork_state('fork005', 'ok')
+    # A line that is shown stops matching
+    app.set_fork_state('fork001', 'running')
+
+    app.root.run_idle()
+    assert app.repotable.lines == [
+        'fork000', 'fork002', 'fork003', 'fork004', 'fork006', 'fork007',
+        'fork009', 'fork015'
+    ]
+
+def test_name_filter():
+    app = make_app(20)
+    app.name_filter.set(' FORK01 ')
+    app.apply_filter()
+    assert app.repotable.lines == ['fork%03d' % n for n in range(10, 20)]
+
+def test_summary_counts_current_run():
+    app = make_app(5)
+    app.insert_rows(app.sorted_fork_names)
+    app.rebase_started = time.time()
+    for name in app.sorted_fork_names[:3]:
+        app.set_fork_state(name, 'ok')
+    app.set_fork_state('fork003', 'failed')
+    assert app.state_counts == {
+        'pending': 1, 'running': 0, 'ok': 3, 'skipped': 0, 'failed': 1
+    }
+    assert app.repotable.tags['fork003'] == ('failed', )
+
+    # A second run of one fork counts only that fork
+    app.rebase_started = time.time()
+    app.rebase_finished = 0
+    app.set_fork_state('fork004', 'skipped')
+    app.set_fork_state('fork000', 'failed')
+    assert app.summary.get().startswith(
+        'Pending: 0   Running: 0   Ok: 2   Skipped: 1   Failed: 2   |   '\
+        '1 forks in '
+    )
+
+@pytest.fixture
+def layout(tmp_path):
+    """
+    Returns a base directory with forks at several depths, and directories
+    that are not forks
+    """
+    for path in ['top', '.hidden', 't1/s1/repo', 't1/s2/repo', 't2/s2/repo',
+                 'archive/repo', 't2/archive/repo']:
+        git(tmp_path, 'init', '-q', str(tmp_path / path))
+    (tmp_path / 'plain' / 'deeper').mkdir(parents=True)
+    (tmp_path / 'broken').mkdir()
+    (tmp_path / 'broken' / '.git').write_text('gitdir: /nowhere\n')
+    return tmp_path
+
+def find_forks(basedir, max_depth=1, include=(), exclude=()):
+    """
+    Returns the fork names App.find_forks finds with the given options
+    """
+    app = App.__new__(App)
+    app.args = argparse.Namespace(
+        max_depth=max_depth,
+        include=list(include),
+        exclude=list(exclude),
+        jobs=2
+    )
+    app.basedir = str(basedir)
+    app.forks = {}
+    app.find_forks()
+    return app.sorted_fork_names
+
+def test_find_forks_depth(layout, capsys):
+    assert find_forks(layout) == ['top']
+    assert find_forks(layout, 2) == ['archive/repo', 'top']
+    assert find_forks(layout, 3) == [
+        'archive/repo', 't1/s1/repo', 't1/s2/repo', 't2/archive/repo',
+        't2/s2/repo', 'top'
+    ]
+    # The broken .git file is found but rejected by git
+    assert 'Skipping broken' in capsys.readouterr().err
+
+def test_find_forks_include(layout):
+    assert find_forks(layout, 3, include=['t1/*']) ==\
+        ['t1/s1/repo', 't1/s2/repo']
+    # * also matches /
+    assert find_forks(layout, 3, include=['t*repo']) ==\
+        ['t1/s1/repo', 't1/s2/repo', 't2/archive/repo', 't2/s2/repo']
+
+def test_find_forks_exclude(layout):
+    # A plain name only matches at the top level
+    assert find_forks(layout, 3, exclude=['archive']) == [
+        't1/s1/repo', 't1/s2/repo', 't2/archive/repo', 't2/s2/repo', 'top'
+    ]
+    assert find_forks(layout, 3, exclude=['*archive']) ==\
+        ['t1/s1/repo', 't1/s2/repo', 't2/s2/repo', 'top']
+    assert find_forks(layout, 3, exclude=['*/s2']) ==\
+        ['archive/repo', 't1/s1/repo', 't2/archive/repo', 'top']